@@ -304,9 +304,10 @@ class FluxDiT(torch.nn.Module):
 
     def prepare_image_ids(self, latents):
         batch_size, _, height, width = latents.shape
-        latent_image_ids = torch.zeros(height // 2, width // 2, 3)
-        latent_image_ids[..., 1] = latent_image_ids[..., 1] + torch.arange(height // 2)[:, None]
-        latent_image_ids[..., 2] = latent_image_ids[..., 2] + torch.arange(width // 2)[None, :]
+        # Build the ids on the target device, since CPU ops prevent CUDA Graph capture of the compiled model.
+        latent_image_ids = torch.zeros(height // 2, width // 2, 3, device=latents.device)
+        latent_image_ids[..., 1] = latent_image_ids[..., 1] + torch.arange(height // 2, device=latents.device)[:, None]
+        latent_image_ids[..., 2] = latent_image_ids[..., 2] + torch.arange(width // 2, device=latents.device)[None, :]
 
         latent_image_id_height, latent_image_id_width, latent_image_id_channels = latent_image_ids.shape
 
@@ -343,7 +344,7 @@ class FluxDiT(torch.nn.Module):
         batch_size = entity_masks[0].shape[0]
         total_seq_len = N * prompt_seq_len + image_seq_len
         patched_masks = [self.patchify(entity_masks[i]) for i in range(N)]
-        attention_mask = torch.ones((batch_size, total_seq_len, total_seq_len), dtype=torch.bool).to(device=entity_masks[0].device)
+        attention_mask = torch.ones((batch_size, total_seq_len, total_seq_len), dtype=torch.bool, device=entity_masks[0].device)
 
         image_start = N * prompt_seq_len
         image_end = N * prompt_seq_len + image_seq_len
@@ -367,9 +368,8 @@ class FluxDiT(torch.nn.Module):
                     prompt_end_j = (j + 1) * prompt_seq_len
                     attention_mask[:, prompt_start_i:prompt_end_i, prompt_start_j:prompt_end_j] = False
 
-        attention_mask = attention_mask.float()
-        attention_mask[attention_mask == 0] = float('-inf')
-        attention_mask[attention_mask == 1] = 0
+        # Additive bias instead of a boolean mask, which is supported by the fused attention kernels (e.g., cuDNN)
+        attention_mask = torch.zeros_like(attention_mask, dtype=torch.float).masked_fill_(~attention_mask, float('-inf'))
         return attention_mask
 
 
@@ -407,7 +407,9 @@ class FluxDiT(torch.nn.Module):
         hidden_states,
         timestep, prompt_emb, pooled_prompt_emb, guidance, text_ids, image_ids=None,
         tiled=False, tile_size=128, tile_stride=64, entity_prompt_emb=None, entity_masks=None,
-        use_gradient_checkpointing=False,
+        ipadapter_kwargs_list=None, controlnet_res_stack=None, controlnet_single_res_stack=None,
+        image_rotary_emb=None, context_embedded_prompt_emb=None, pooled_cond=None, guidance_cond=None,
+        tea_cache=None, use_gradient_checkpointing=False,
         **kwargs
     ):
         if tiled:
@@ -421,10 +423,11 @@ class FluxDiT(torch.nn.Module):
         if image_ids is None:
             image_ids = self.prepare_image_ids(hidden_states)
 
-        conditioning = self.time_embedder(timestep, hidden_states.dtype) + self.pooled_text_embedder(pooled_prompt_emb)
+        # The pooled text and guidance embeddings can be precomputed, since they don't depend on the timestep.
+        conditioning = self.time_embedder(timestep, hidden_states.dtype)
+        conditioning = conditioning + (self.pooled_text_embedder(pooled_prompt_emb) if pooled_cond is None else pooled_cond)
         if self.guidance_embedder is not None:
-            guidance = guidance * 1000
-            conditioning = conditioning + self.guidance_embedder(guidance, hidden_states.dtype)
+            conditioning = conditioning + (self.guidance_embedder(guidance * 1000, hidden_states.dtype) if guidance_cond is None else guidance_cond)
 
         height, width = hidden_states.shape[-2:]
         hidden_states = self.patchify(hidden_states)
@@ -433,8 +436,10 @@ class FluxDiT(torch.nn.Module):
         if entity_prompt_emb is not None and entity_masks is not None:
             prompt_emb, image_rotary_emb, attention_mask = self.process_entity_masks(hidden_states, prompt_emb, entity_prompt_emb, entity_masks, text_ids, image_ids)
         else:
-            prompt_emb = self.context_embedder(prompt_emb)
-            image_rotary_emb = self.pos_embedder(torch.cat((text_ids, image_ids), dim=1))
+            # The context embedding and the RoPE table can be precomputed, since they don't depend on the timestep.
+            prompt_emb = self.context_embedder(prompt_emb) if context_embedded_prompt_emb is None else context_embedded_prompt_emb
+            if image_rotary_emb is None:
+                image_rotary_emb = self.pos_embedder(torch.cat((text_ids, image_ids), dim=1))
             attention_mask = None
 
         def create_custom_forward(module):
@@ -442,27 +447,48 @@ class FluxDiT(torch.nn.Module):
                 return module(*inputs)
             return custom_forward
 
-        for block in self.blocks:
-            if self.training and use_gradient_checkpointing:
-                hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
-                    create_custom_forward(block),
-                    hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask,
-                    use_reentrant=False,
-                )
-            else:
-                hidden_states, prompt_emb = block(hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask)
-
-        hidden_states = torch.cat([prompt_emb, hidden_states], dim=1)
-        for block in self.single_blocks:
-            if self.training and use_gradient_checkpointing:
-                hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
-                    create_custom_forward(block),
-                    hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask,
-                    use_reentrant=False,
-                )
-            else:
-                hidden_states, prompt_emb = block(hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask)
-        hidden_states = hidden_states[:, prompt_emb.shape[1]:]
+        # TeaCache
+        tea_cache_update = tea_cache.check(self, hidden_states, conditioning) if tea_cache is not None else False
+
+        if tea_cache_update:
+            hidden_states = tea_cache.update(hidden_states)
+        else:
+            for block_id, block in enumerate(self.blocks):
+                if self.training and use_gradient_checkpointing:
+                    hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
+                        create_custom_forward(block),
+                        hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask,
+                        use_reentrant=False,
+                    )
+                else:
+                    hidden_states, prompt_emb = block(
+                        hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask,
+                        ipadapter_kwargs_list=ipadapter_kwargs_list[block_id] if ipadapter_kwargs_list is not None else None
+                    )
+                # ControlNet
+                if controlnet_res_stack is not None:
+                    hidden_states = hidden_states + controlnet_res_stack[block_id]
+
+            hidden_states = torch.cat([prompt_emb, hidden_states], dim=1)
+            num_joint_blocks = len(self.blocks)
+            for block_id, block in enumerate(self.single_blocks):
+                if self.training and use_gradient_checkpointing:
+                    hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
+                        create_custom_forward(block),
+                        hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask,
+                        use_reentrant=False,
+                    )
+                else:
+                    hidden_states, prompt_emb = block(
+                        hidden_states, prompt_emb, conditioning, image_rotary_emb, attention_mask,
+                        ipadapter_kwargs_list=ipadapter_kwargs_list[block_id + num_joint_blocks] if ipadapter_kwargs_list is not None else None
+                    )
+                # ControlNet
+                if controlnet_single_res_stack is not None:
+                    hidden_states[:, prompt_emb.shape[1]:] = hidden_states[:, prompt_emb.shape[1]:] + controlnet_single_res_stack[block_id]
+            hidden_states = hidden_states[:, prompt_emb.shape[1]:]
+            if tea_cache is not None:
+                tea_cache.store(hidden_states)
 
         hidden_states = self.final_norm_out(hidden_states, conditioning)
         hidden_states = self.final_proj_out(hidden_states)
@@ -32,6 +32,15 @@ class BasePipeline(torch.nn.Module):
         return image
     
 
+    def host_to_device(self, tensor, **kwargs):
+        # Copy from pinned memory without blocking, so that the copy overlaps with the queued GPU work.
+        if torch.device(self.device).type != "cuda":
+            return tensor.to(device=self.device, **kwargs)
+        if not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor.to(device=self.device, non_blocking=True, **kwargs)
+
+
     def preprocess_images(self, images):
         return [self.preprocess_image(image) for image in images]
     
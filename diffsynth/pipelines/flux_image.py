@@ -4,24 +4,39 @@ from ..prompters import FluxPrompter
 from ..schedulers import FlowMatchScheduler
 from .base import BasePipeline
 from typing import List
-import torch
+import torch, contextlib
+from collections import OrderedDict
 from tqdm import tqdm
 import numpy as np
 from PIL import Image
 from ..models.tiler import FastTileWorker
 from transformers import SiglipVisionModel
-from copy import deepcopy
 from transformers.models.t5.modeling_t5 import T5LayerNorm, T5DenseActDense, T5DenseGatedActDense
 from ..models.flux_dit import RMSNorm
 from ..vram_management import enable_vram_management, AutoWrappedModule, AutoWrappedLinear
 
+try:
+    import modelopt.torch.quantization as mtq
+    MODELOPT_AVAILABLE = True
+except ModuleNotFoundError:
+    MODELOPT_AVAILABLE = False
+
 
 class FluxImagePipeline(BasePipeline):
 
-    def __init__(self, device="cuda", torch_dtype=torch.float16):
+    def __init__(self, device="cuda", torch_dtype=torch.float16, compile_model=False, compile_mode="reduce-overhead", compile_blocks=False, compile_components=()):
         super().__init__(device=device, torch_dtype=torch_dtype, height_division_factor=16, width_division_factor=16)
         self.scheduler = FlowMatchScheduler()
         self.prompter = FluxPrompter()
+        # torch.compile
+        self.compile_model = compile_model
+        self.compile_mode = compile_mode
+        self.compile_blocks = compile_blocks
+        self.compile_components = compile_components
+        self.last_t5_sequence_length = None
+        # Recently encoded negative prompts (LRU), keyed by (negative_prompt, t5_sequence_length)
+        self.negative_prompt_emb_cache = OrderedDict()
+        self.negative_prompt_emb_cache_size = 4
         # models
         self.text_encoder_1: SD3TextEncoder1 = None
         self.text_encoder_2: FluxTextEncoder2 = None
@@ -143,7 +158,12 @@ class FluxImagePipeline(BasePipeline):
         self.dit = model_manager.fetch_model("flux_dit")
         self.vae_decoder = model_manager.fetch_model("flux_vae_decoder")
         self.vae_encoder = model_manager.fetch_model("flux_vae_encoder")
+        # The VAE consists of convolution layers, which are faster in channels_last format.
+        for model in [self.vae_decoder, self.vae_encoder]:
+            if model is not None:
+                model.to(memory_format=torch.channels_last)
         self.prompter.fetch_models(self.text_encoder_1, self.text_encoder_2)
+        self.negative_prompt_emb_cache.clear()
         self.prompter.load_prompt_refiners(model_manager, prompt_refiner_classes)
         self.prompter.load_prompt_extenders(model_manager, prompt_extender_classes)
 
@@ -162,24 +182,81 @@ class FluxImagePipeline(BasePipeline):
         self.ipadapter = model_manager.fetch_model("flux_ipadapter")
         self.ipadapter_image_encoder = model_manager.fetch_model("siglip_vision_model")
 
+        # torch.compile
+        # The DiT is compiled in place, so that it keeps its state_dict keys (e.g., for LoRA).
+        # Note that the DiT is shared with the ModelManager, so other pipelines built from the same ModelManager also use the compiled DiT.
+        if self.compile_model and self.dit is not None:
+            assert hasattr(torch.nn.Module, "compile"), "Compiling the DiT requires torch>=2.2. Please upgrade PyTorch."
+            self.dit.compile(mode=self.compile_mode, fullgraph=True, dynamic=False)
+        elif self.compile_blocks and self.dit is not None:
+            self.compile_dit_blocks()
+        self.compile_pipeline_components()
+
+
+    def calibrate_dit_quantization(self, quantize="fp8", calib_prompts=None, num_inference_steps=20, height=1024, width=1024):
+        # Calibrate FP8/NVFP4 quantization of the DiT with NVIDIA Model Optimizer, in preparation for exporting it to a deployment runtime (e.g., TensorRT).
+        # This is not an inference speedup: mtq.quantize only inserts simulated (fake) quantizers, so eager inference becomes slower and its output changes.
+        # To store the weights in FP8 for inference, load the DiT with torch_dtype=torch.float8_e4m3fn and call `pipe.dit.quantize()` instead.
+        # Note that the DiT is modified in place, and it is shared with the ModelManager.
+        assert MODELOPT_AVAILABLE, "NVIDIA Model Optimizer is required for quantization. Please install it via `pip install nvidia-modelopt`."
+        assert not (self.compile_model or self.compile_blocks), "The compiled DiT cannot be calibrated. Please disable `compile_model` and `compile_blocks`."
+        # Activation ranges are calibrated by running the pipeline on a few prompts.
+        if calib_prompts is None:
+            calib_prompts = ("a photo of a cat", "a beautiful landscape with mountains and a lake", "a portrait of a young woman, oil painting")
+        def forward_loop(dit):
+            for prompt in calib_prompts:
+                self(prompt, num_inference_steps=num_inference_steps, height=height, width=width, seed=0, progress_bar_cmd=lambda x: x)
+        self.dit = mtq.quantize(self.dit, flux_dit_quant_config(quantize), forward_loop)
+
+
+    def compile_dit_blocks(self):
+        # Each transformer block is captured separately, while ControlNet residuals, EliGen and TeaCache stay in Python.
+        # The blocks are compiled in place, so that the DiT keeps its modules and state_dict keys (e.g., for LoRA).
+        # Note that the DiT is shared with the ModelManager, so other pipelines built from the same ModelManager also use the compiled blocks.
+        assert hasattr(torch.nn.Module, "compile"), "Compiling the blocks of the DiT requires torch>=2.2. Please upgrade PyTorch."
+        for block in list(self.dit.blocks) + list(self.dit.single_blocks):
+            block.compile(mode=self.compile_mode, fullgraph=False)
+        print("The blocks of the DiT are compiled. The first call will be slow (about 1 minute) due to warm-up.")
+
+
+    def compile_pipeline_components(self):
+        # Compile the other components, e.g., ("vae_decoder", "vae_encoder", "text_encoder_1", "text_encoder_2", "ipadapter_image_encoder").
+        # Their outputs are kept across calls (e.g., the positive prompt embedding while the negative one is encoded),
+        # but CUDA Graph outputs are overwritten by the next replay, so these components are compiled without CUDA Graphs.
+        mode = {"reduce-overhead": "default", "max-autotune": "max-autotune-no-cudagraphs"}.get(self.compile_mode, self.compile_mode)
+        for model_name in self.compile_components:
+            if model_name == "dit" and (self.compile_model or self.compile_blocks):
+                continue
+            model = getattr(self, model_name)
+            if model is not None:
+                setattr(self, model_name, torch.compile(model, mode=mode, fullgraph=False, dynamic=False))
+        # The prompter holds its own references to the text encoders.
+        self.prompter.fetch_models(self.text_encoder_1, self.text_encoder_2)
+
 
     @staticmethod
-    def from_model_manager(model_manager: ModelManager, controlnet_config_units: List[ControlNetConfigUnit]=[], prompt_refiner_classes=[], prompt_extender_classes=[], device=None, torch_dtype=None):
+    def from_model_manager(model_manager: ModelManager, controlnet_config_units: List[ControlNetConfigUnit]=[], prompt_refiner_classes=[], prompt_extender_classes=[], device=None, torch_dtype=None, compile_model=False, compile_mode="reduce-overhead", compile_blocks=False, compile_components=()):
         pipe = FluxImagePipeline(
             device=model_manager.device if device is None else device,
             torch_dtype=model_manager.torch_dtype if torch_dtype is None else torch_dtype,
+            compile_model=compile_model,
+            compile_mode=compile_mode,
+            compile_blocks=compile_blocks,
+            compile_components=compile_components,
         )
         pipe.fetch_models(model_manager, controlnet_config_units, prompt_refiner_classes, prompt_extender_classes)
         return pipe
     
 
     def encode_image(self, image, tiled=False, tile_size=64, tile_stride=32):
+        image = image.to(memory_format=torch.channels_last)
         latents = self.vae_encoder(image, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
         return latents
     
 
     def decode_image(self, latent, tiled=False, tile_size=64, tile_stride=32):
-        image = self.vae_decoder(latent.to(self.device), tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
+        latent = latent.to(device=self.device, memory_format=torch.channels_last)
+        image = self.vae_decoder(latent, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
         image = self.vae_output_to_image(image)
         return image
     
@@ -191,48 +268,90 @@ class FluxImagePipeline(BasePipeline):
         return {"prompt_emb": prompt_emb, "pooled_prompt_emb": pooled_prompt_emb, "text_ids": text_ids}
     
 
+    def encode_negative_prompt(self, negative_prompt, t5_sequence_length=512):
+        # The negative prompt is usually the same across calls, so its encoding is cached.
+        if not isinstance(negative_prompt, str):
+            return self.encode_prompt(negative_prompt, positive=False, t5_sequence_length=t5_sequence_length)
+        key = (negative_prompt, t5_sequence_length)
+        if key in self.negative_prompt_emb_cache:
+            self.negative_prompt_emb_cache.move_to_end(key)
+        else:
+            # The cached tensors are owned copies, not views of the text encoders' output buffers.
+            prompt_emb = self.encode_prompt(negative_prompt, positive=False, t5_sequence_length=t5_sequence_length)
+            self.negative_prompt_emb_cache[key] = {name: tensor.clone() for name, tensor in prompt_emb.items()}
+            if len(self.negative_prompt_emb_cache) > self.negative_prompt_emb_cache_size:
+                self.negative_prompt_emb_cache.popitem(last=False)
+        return self.negative_prompt_emb_cache[key]
+    
+
     def prepare_extra_input(self, latents=None, guidance=1.0):
         latent_image_ids = self.dit.prepare_image_ids(latents)
-        guidance = torch.Tensor([guidance] * latents.shape[0]).to(device=latents.device, dtype=latents.dtype)
+        guidance = torch.full((latents.shape[0],), guidance, device=latents.device, dtype=latents.dtype)
         return {"image_ids": latent_image_ids, "guidance": guidance}
+
+
+    def prepare_embedding_cache(self, prompt_emb_posi, prompt_emb_nega, prompt_emb_locals, extra_input):
+        # The context embeddings, the pooled text and guidance embeddings and the RoPE table are constant across denoising steps, so they are computed only once.
+        # The text_ids of all prompts are identical.
+        image_rotary_emb = self.dit.pos_embedder(torch.cat((prompt_emb_posi["text_ids"], extra_input["image_ids"]), dim=1))
+        extra_input = {**extra_input, "image_rotary_emb": image_rotary_emb}
+        if self.dit.guidance_embedder is not None:
+            extra_input["guidance_cond"] = self.dit.guidance_embedder(extra_input["guidance"] * 1000, self.torch_dtype)
+        embed_context = lambda prompt_emb: {
+            **prompt_emb,
+            "context_embedded_prompt_emb": self.dit.context_embedder(prompt_emb["prompt_emb"]),
+            "pooled_cond": self.dit.pooled_text_embedder(prompt_emb["pooled_prompt_emb"]),
+        }
+        prompt_emb_posi = embed_context(prompt_emb_posi)
+        prompt_emb_nega = embed_context(prompt_emb_nega) if prompt_emb_nega is not None else None
+        prompt_emb_locals = [embed_context(prompt_emb_local) for prompt_emb_local in prompt_emb_locals]
+        return prompt_emb_posi, prompt_emb_nega, prompt_emb_locals, extra_input
     
 
     def apply_controlnet_mask_on_latents(self, latents, mask):
-        mask = (self.preprocess_image(mask) + 1) / 2
-        mask = mask.mean(dim=1, keepdim=True)
-        mask = mask.to(dtype=self.torch_dtype, device=self.device)
+        mask = (self.host_to_device(self.preprocess_image(mask)) + 1) / 2
+        mask = mask.mean(dim=1, keepdim=True).to(dtype=self.torch_dtype)
         mask = 1 - torch.nn.functional.interpolate(mask, size=latents.shape[-2:])
         latents = torch.concat([latents, mask], dim=1)
         return latents
     
 
-    def apply_controlnet_mask_on_image(self, image, mask):
-        mask = mask.resize(image.size)
-        mask = self.preprocess_image(mask).mean(dim=[0, 1])
-        image = np.array(image)
-        image[mask > 0] = 0
-        image = Image.fromarray(image)
+    def apply_controlnet_mask_on_image_tensor(self, image, mask):
+        # The masked pixels are set to black (-1) on the computation device.
+        mask = self.host_to_device(torch.from_numpy(np.array(mask.convert("RGB"))))
+        mask = (mask.permute(2, 0, 1).unsqueeze(0).to(dtype=torch.float32) * (2 / 255) - 1).mean(dim=1, keepdim=True)
+        mask = torch.nn.functional.interpolate(mask, size=image.shape[-2:], mode="bicubic", align_corners=False)
+        image = image.masked_fill(mask > 0, -1)
         return image
     
 
-    def prepare_controlnet_input(self, controlnet_image, controlnet_inpaint_mask, tiler_kwargs):
+    def prepare_controlnet_input(self, controlnet_image, controlnet_inpaint_mask, tiler_kwargs, cache=None):
+        # The annotated images and the latents that don't depend on the mask can be reused across masks via `cache`.
+        cache = {"images": {}, "latents": {}} if cache is None else cache
         if isinstance(controlnet_image, Image.Image):
             controlnet_image = [controlnet_image] * len(self.controlnet.processors)
 
         controlnet_frames = []
         for i in range(len(self.controlnet.processors)):
-            # image annotator
-            image = self.controlnet.process_image(controlnet_image[i], processor_id=i)[0]
-            if controlnet_inpaint_mask is not None and self.controlnet.processors[i].processor_id == "inpaint":
-                image = self.apply_controlnet_mask_on_image(image, controlnet_inpaint_mask)
-
-            # image to tensor
-            image = self.preprocess_image(image).to(device=self.device, dtype=self.torch_dtype)
+            apply_mask = controlnet_inpaint_mask is not None and self.controlnet.processors[i].processor_id == "inpaint"
+            if not apply_mask and i in cache["latents"]:
+                controlnet_frames.append(cache["latents"][i])
+                continue
+
+            # image annotator and image to tensor
+            if i not in cache["images"]:
+                image = self.controlnet.process_image(controlnet_image[i], processor_id=i)[0]
+                cache["images"][i] = self.host_to_device(self.preprocess_image(image), dtype=self.torch_dtype)
+            image = cache["images"][i]
+            if apply_mask:
+                image = self.apply_controlnet_mask_on_image_tensor(image, controlnet_inpaint_mask)
 
             # vae encoder
             image = self.encode_image(image, **tiler_kwargs)
-            if controlnet_inpaint_mask is not None and self.controlnet.processors[i].processor_id == "inpaint":
+            if apply_mask:
                 image = self.apply_controlnet_mask_on_latents(image, controlnet_inpaint_mask)
+            else:
+                cache["latents"][i] = image
             
             # store it
             controlnet_frames.append(image)
@@ -240,42 +359,37 @@ class FluxImagePipeline(BasePipeline):
 
 
     def prepare_ipadapter_inputs(self, images, height=384, width=384):
-        images = [image.convert("RGB").resize((width, height), resample=3) for image in images]
-        images = [self.preprocess_image(image).to(device=self.device, dtype=self.torch_dtype) for image in images]
-        return torch.cat(images, dim=0)
+        # The images are copied as uint8 and resized on the computation device. They may have different sizes, so they are resized one by one.
+        images = [self.host_to_device(torch.from_numpy(np.array(image.convert("RGB")))) for image in images]
+        images = [image.permute(2, 0, 1).unsqueeze(0).to(dtype=torch.float32) * (2 / 255) - 1 for image in images]
+        images = [torch.nn.functional.interpolate(image, size=(height, width), mode="bicubic", align_corners=False, antialias=True) for image in images]
+        images = torch.cat(images, dim=0).clamp(-1, 1).to(dtype=self.torch_dtype)
+        return images
 
 
     def inpaint_fusion(self, latents, inpaint_latents, pred_noise, fg_mask, bg_mask, progress_id, background_weight=0.):
-        # inpaint noise
-        inpaint_noise = (latents - inpaint_latents) / self.scheduler.sigmas[progress_id]
-        # merge noise
-        weight = torch.ones_like(inpaint_noise)
-        inpaint_noise[fg_mask] = pred_noise[fg_mask]
-        inpaint_noise[bg_mask] += pred_noise[bg_mask] * background_weight
-        weight[bg_mask] += background_weight
-        inpaint_noise /= weight
+        inpaint_noise = fuse_inpaint_noise(latents, inpaint_latents, pred_noise, fg_mask, bg_mask, self.scheduler.sigmas[progress_id], float(background_weight))
         return inpaint_noise
 
 
     def preprocess_masks(self, masks, height, width, dim):
-        out_masks = []
-        for mask in masks:
-            mask = self.preprocess_image(mask.resize((width, height), resample=Image.NEAREST)).mean(dim=1, keepdim=True) > 0
-            mask = mask.repeat(1, dim, 1, 1).to(device=self.device, dtype=self.torch_dtype)
-            out_masks.append(mask)
-        return out_masks
+        # Each mask is reduced to its channel mean after resizing (the masks may have different modes, e.g., RGB and RGBA),
+        # then the masks are stacked and binarized in a single batch.
+        masks = [np.array(mask.resize((width, height), resample=Image.NEAREST), dtype=np.float32) for mask in masks]
+        masks = np.stack([mask.reshape(height, width, -1).mean(axis=-1) for mask in masks])
+        masks = self.host_to_device(torch.from_numpy(masks))
+        masks = (masks * (2 / 255) - 1).unsqueeze(1) > 0
+        masks = masks.repeat(1, dim, 1, 1).to(dtype=self.torch_dtype)
+        return masks
 
 
     def prepare_entity_inputs(self, entity_prompts, entity_masks, width, height, t5_sequence_length=512, enable_eligen_inpaint=False):
+        entity_masks = self.preprocess_masks(entity_masks, height//8, width//8, 1) # n_mask, c, h, w
         fg_mask, bg_mask = None, None
         if enable_eligen_inpaint:
-            masks_ = deepcopy(entity_masks)
-            fg_masks = torch.cat([self.preprocess_image(mask.resize((width//8, height//8))).mean(dim=1, keepdim=True) for mask in masks_])
-            fg_masks = (fg_masks > 0).float()
-            fg_mask = fg_masks.sum(dim=0, keepdim=True).repeat(1, 16, 1, 1) > 0
-            bg_mask = ~fg_mask
-        entity_masks = self.preprocess_masks(entity_masks, height//8, width//8, 1)
-        entity_masks = torch.cat(entity_masks, dim=0).unsqueeze(0) # b, n_mask, c, h, w
+            fg_mask = (entity_masks.sum(dim=0, keepdim=True) > 0).repeat(1, 16, 1, 1).to(dtype=self.torch_dtype)
+            bg_mask = 1 - fg_mask
+        entity_masks = entity_masks.unsqueeze(0) # b, n_mask, c, h, w
         entity_prompts = self.encode_prompt(entity_prompts, t5_sequence_length=t5_sequence_length)['prompt_emb'].unsqueeze(0)
         return entity_prompts, entity_masks, fg_mask, bg_mask
 
@@ -283,7 +397,7 @@ class FluxImagePipeline(BasePipeline):
     def prepare_latents(self, input_image, height, width, seed, tiled, tile_size, tile_stride):
         if input_image is not None:
             self.load_models_to_device(['vae_encoder'])
-            image = self.preprocess_image(input_image).to(device=self.device, dtype=self.torch_dtype)
+            image = self.host_to_device(self.preprocess_image(input_image), dtype=self.torch_dtype)
             input_latents = self.encode_image(image, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
             noise = self.generate_noise((1, 16, height//8, width//8), seed=seed, device=self.device, dtype=self.torch_dtype)
             latents = self.scheduler.add_noise(input_latents, noise, timestep=self.scheduler.timesteps[0])
@@ -293,38 +407,68 @@ class FluxImagePipeline(BasePipeline):
         return latents, input_latents
 
 
-    def prepare_ipadapter(self, ipadapter_images, ipadapter_scale):
+    def prepare_latents_and_prompts_in_parallel(self, input_image, height, width, seed, tiled, tile_size, tile_stride, prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, use_cfg):
+        # The VAE encoder and the text encoders are independent, so they run on two CUDA streams.
+        # All of them are loaded in advance, and offloading is paused so that no model is moved while the other stream is running.
+        self.load_models_to_device(['vae_encoder', 'text_encoder_1', 'text_encoder_2'])
+        cpu_offload, self.cpu_offload = self.cpu_offload, False
+        try:
+            vae_stream, text_stream = torch.cuda.Stream(device=self.device), torch.cuda.Stream(device=self.device)
+            vae_stream.wait_stream(torch.cuda.current_stream(self.device))
+            text_stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(vae_stream):
+                latents, input_latents = self.prepare_latents(input_image, height, width, seed, tiled, tile_size, tile_stride)
+            with torch.cuda.stream(text_stream):
+                prompt_emb_posi, prompt_emb_nega, prompt_emb_locals = self.prepare_prompts(prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, use_cfg)
+            torch.cuda.synchronize(self.device)
+        finally:
+            self.cpu_offload = cpu_offload
+        return latents, input_latents, prompt_emb_posi, prompt_emb_nega, prompt_emb_locals
+
+
+    def prepare_ipadapter(self, ipadapter_images, ipadapter_scale, use_cfg=True):
         if ipadapter_images is not None:
             self.load_models_to_device(['ipadapter_image_encoder'])
             ipadapter_images = self.prepare_ipadapter_inputs(ipadapter_images)
             ipadapter_image_encoding = self.ipadapter_image_encoder(ipadapter_images).pooler_output
             self.load_models_to_device(['ipadapter'])
-            ipadapter_kwargs_list_posi = {"ipadapter_kwargs_list": self.ipadapter(ipadapter_image_encoding, scale=ipadapter_scale)}
-            ipadapter_kwargs_list_nega = {"ipadapter_kwargs_list": self.ipadapter(torch.zeros_like(ipadapter_image_encoding))}
+            ipadapter_kwargs_list_posi = {"ipadapter_kwargs_list": self.ipadapter_kwargs_per_block(self.ipadapter(ipadapter_image_encoding, scale=ipadapter_scale))}
+            ipadapter_kwargs_list_nega = {"ipadapter_kwargs_list": self.ipadapter_kwargs_per_block(self.ipadapter(torch.zeros_like(ipadapter_image_encoding)))} if use_cfg else None
         else:
-            ipadapter_kwargs_list_posi, ipadapter_kwargs_list_nega = {"ipadapter_kwargs_list": {}}, {"ipadapter_kwargs_list": {}}
+            ipadapter_kwargs_list_posi = {"ipadapter_kwargs_list": None}
+            ipadapter_kwargs_list_nega = {"ipadapter_kwargs_list": None} if use_cfg else None
         return ipadapter_kwargs_list_posi, ipadapter_kwargs_list_nega
 
 
-    def prepare_controlnet(self, controlnet_image, masks, controlnet_inpaint_mask, tiler_kwargs, enable_controlnet_on_negative):
+    def ipadapter_kwargs_per_block(self, ipadapter_kwargs_dict):
+        # A list indexed by block id (None for blocks without IP-Adapter) avoids dict lookups inside the compiled graph.
+        num_blocks = len(self.dit.blocks) + len(self.dit.single_blocks)
+        return [ipadapter_kwargs_dict.get(block_id, None) for block_id in range(num_blocks)]
+
+
+    def prepare_controlnet(self, controlnet_image, masks, controlnet_inpaint_mask, tiler_kwargs, enable_controlnet_on_negative, use_cfg=True):
         if controlnet_image is not None:
             self.load_models_to_device(['vae_encoder'])
-            controlnet_kwargs_posi = {"controlnet_frames": self.prepare_controlnet_input(controlnet_image, controlnet_inpaint_mask, tiler_kwargs)}
+            cache = {"images": {}, "latents": {}}
+            controlnet_kwargs_posi = {"controlnet_frames": self.prepare_controlnet_input(controlnet_image, controlnet_inpaint_mask, tiler_kwargs, cache)}
             if len(masks) > 0 and controlnet_inpaint_mask is not None:
                 print("The controlnet_inpaint_mask will be overridden by masks.")
-                local_controlnet_kwargs = [{"controlnet_frames": self.prepare_controlnet_input(controlnet_image, mask, tiler_kwargs)} for mask in masks]
+                local_controlnet_kwargs = [{"controlnet_frames": self.prepare_controlnet_input(controlnet_image, mask, tiler_kwargs, cache)} for mask in masks]
             else:
                 local_controlnet_kwargs = None
         else:
             controlnet_kwargs_posi, local_controlnet_kwargs = {"controlnet_frames": None}, [{}] * len(masks)
-        controlnet_kwargs_nega = controlnet_kwargs_posi if enable_controlnet_on_negative else {}
+        if use_cfg:
+            controlnet_kwargs_nega = controlnet_kwargs_posi if enable_controlnet_on_negative else {}
+        else:
+            controlnet_kwargs_nega = None
         return controlnet_kwargs_posi, controlnet_kwargs_nega, local_controlnet_kwargs
 
 
-    def prepare_eligen(self, prompt_emb_nega, eligen_entity_prompts, eligen_entity_masks, width, height, t5_sequence_length, enable_eligen_inpaint, enable_eligen_on_negative, cfg_scale):
+    def prepare_eligen(self, prompt_emb_nega, eligen_entity_prompts, eligen_entity_masks, width, height, t5_sequence_length, enable_eligen_inpaint, enable_eligen_on_negative, use_cfg=True):
         if eligen_entity_masks is not None:
             entity_prompt_emb_posi, entity_masks_posi, fg_mask, bg_mask = self.prepare_entity_inputs(eligen_entity_prompts, eligen_entity_masks, width, height, t5_sequence_length, enable_eligen_inpaint)
-            if enable_eligen_on_negative and cfg_scale != 1.0:
+            if enable_eligen_on_negative and use_cfg:
                 entity_prompt_emb_nega = prompt_emb_nega['prompt_emb'].unsqueeze(1).repeat(1, entity_masks_posi.shape[1], 1, 1)
                 entity_masks_nega = entity_masks_posi
             else:
@@ -333,22 +477,54 @@ class FluxImagePipeline(BasePipeline):
             entity_prompt_emb_posi, entity_masks_posi, entity_prompt_emb_nega, entity_masks_nega = None, None, None, None
             fg_mask, bg_mask = None, None
         eligen_kwargs_posi = {"entity_prompt_emb": entity_prompt_emb_posi, "entity_masks": entity_masks_posi}
-        eligen_kwargs_nega = {"entity_prompt_emb": entity_prompt_emb_nega, "entity_masks": entity_masks_nega}
+        eligen_kwargs_nega = {"entity_prompt_emb": entity_prompt_emb_nega, "entity_masks": entity_masks_nega} if use_cfg else None
         return eligen_kwargs_posi, eligen_kwargs_nega, fg_mask, bg_mask
 
 
-    def prepare_prompts(self, prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, cfg_scale):
+    def prepare_prompts(self, prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, use_cfg=True):
+        # Compiled models are specialized to static shapes.
+        if len(self.compile_components) > 0 and self.last_t5_sequence_length not in (None, t5_sequence_length):
+            print(f"t5_sequence_length is changed from {self.last_t5_sequence_length} to {t5_sequence_length}. The compiled models will be recompiled.")
+        self.last_t5_sequence_length = t5_sequence_length
+
         # Extend prompt
         self.load_models_to_device(['text_encoder_1', 'text_encoder_2'])
         prompt, local_prompts, masks, mask_scales = self.extend_prompt(prompt, local_prompts, masks, mask_scales)
 
         # Encode prompts
         prompt_emb_posi = self.encode_prompt(prompt, t5_sequence_length=t5_sequence_length)
-        prompt_emb_nega = self.encode_prompt(negative_prompt, positive=False, t5_sequence_length=t5_sequence_length) if cfg_scale != 1.0 else None
+        prompt_emb_nega = self.encode_negative_prompt(negative_prompt, t5_sequence_length=t5_sequence_length) if use_cfg else None
         prompt_emb_locals = [self.encode_prompt(prompt_local, t5_sequence_length=t5_sequence_length) for prompt_local in local_prompts]
         return prompt_emb_posi, prompt_emb_nega, prompt_emb_locals
 
 
+    def can_batch_cfg(self, prompt_emb_locals, controlnet_kwargs_posi, controlnet_kwargs_nega, eligen_kwargs_posi, eligen_kwargs_nega, tea_cache_kwargs):
+        # Local prompts, ControlNets and TeaCache are only applied to one side, so they are processed sequentially.
+        if len(prompt_emb_locals) > 0 or tea_cache_kwargs["tea_cache"] is not None:
+            return False
+        if controlnet_kwargs_posi.get("controlnet_frames", None) is not None or controlnet_kwargs_nega.get("controlnet_frames", None) is not None:
+            return False
+        # The sequence length differs if EliGen is only enabled on the positive side.
+        if (eligen_kwargs_posi["entity_masks"] is None) != (eligen_kwargs_nega["entity_masks"] is None):
+            return False
+        return True
+
+
+    def _broadcast_kwargs(self, kwargs_posi, kwargs_nega):
+        # Concatenate the inputs of the positive and negative sides along the batch dimension.
+        if isinstance(kwargs_posi, dict):
+            return {key: self._broadcast_kwargs(kwargs_posi[key], kwargs_nega[key]) for key in kwargs_posi}
+        elif isinstance(kwargs_posi, list):
+            return [self._broadcast_kwargs(posi, nega) for posi, nega in zip(kwargs_posi, kwargs_nega)]
+        elif isinstance(kwargs_posi, torch.Tensor):
+            return torch.cat([kwargs_posi, kwargs_nega], dim=0)
+        elif kwargs_posi is None:
+            return None
+        else:
+            # Python scalars (e.g., the IP-Adapter scale) become per-sample tensors of shape (2, 1, 1).
+            return torch.tensor([kwargs_posi, kwargs_nega], dtype=self.torch_dtype, device=self.device).view(2, 1, 1)
+
+
     @torch.no_grad()
     def __call__(
         self,
@@ -388,6 +564,10 @@ class FluxImagePipeline(BasePipeline):
         tiled=False,
         tile_size=128,
         tile_stride=64,
+        # Run the VAE encoder and the text encoders in parallel (requires more VRAM if CPU offloading is enabled)
+        parallel_prep=False,
+        # Run the positive and negative sides in a single forward (requires more VRAM, not used if CPU offloading is enabled)
+        batch_cfg=True,
         # Progress bar
         progress_bar_cmd=tqdm,
         progress_bar_st=None,
@@ -397,68 +577,108 @@ class FluxImagePipeline(BasePipeline):
         # Tiler parameters
         tiler_kwargs = {"tiled": tiled, "tile_size": tile_size, "tile_stride": tile_stride}
 
+        # Classifier-free guidance
+        use_cfg = cfg_scale != 1.0
+
         # Prepare scheduler
-        self.scheduler.set_timesteps(num_inference_steps, denoising_strength)
+        self.scheduler.set_timesteps(num_inference_steps, denoising_strength, device=self.device)
 
-        # Prepare latent tensors
-        latents, input_latents = self.prepare_latents(input_image, height, width, seed, tiled, tile_size, tile_stride)
+        if parallel_prep and input_image is not None and torch.device(self.device).type == "cuda":
+            # Prepare latent tensors and prompts in parallel
+            latents, input_latents, prompt_emb_posi, prompt_emb_nega, prompt_emb_locals = self.prepare_latents_and_prompts_in_parallel(
+                input_image, height, width, seed, tiled, tile_size, tile_stride,
+                prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, use_cfg
+            )
+        else:
+            # Prepare latent tensors
+            latents, input_latents = self.prepare_latents(input_image, height, width, seed, tiled, tile_size, tile_stride)
 
-        # Prompt
-        prompt_emb_posi, prompt_emb_nega, prompt_emb_locals = self.prepare_prompts(prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, cfg_scale)
+            # Prompt
+            prompt_emb_posi, prompt_emb_nega, prompt_emb_locals = self.prepare_prompts(prompt, local_prompts, masks, mask_scales, t5_sequence_length, negative_prompt, use_cfg)
 
         # Extra input
         extra_input = self.prepare_extra_input(latents, guidance=embedded_guidance)
 
         # Entity control
-        eligen_kwargs_posi, eligen_kwargs_nega, fg_mask, bg_mask = self.prepare_eligen(prompt_emb_nega, eligen_entity_prompts, eligen_entity_masks, width, height, t5_sequence_length, enable_eligen_inpaint, enable_eligen_on_negative, cfg_scale)
+        eligen_kwargs_posi, eligen_kwargs_nega, fg_mask, bg_mask = self.prepare_eligen(prompt_emb_nega, eligen_entity_prompts, eligen_entity_masks, width, height, t5_sequence_length, enable_eligen_inpaint, enable_eligen_on_negative, use_cfg)
 
         # IP-Adapter
-        ipadapter_kwargs_list_posi, ipadapter_kwargs_list_nega = self.prepare_ipadapter(ipadapter_images, ipadapter_scale)
+        ipadapter_kwargs_list_posi, ipadapter_kwargs_list_nega = self.prepare_ipadapter(ipadapter_images, ipadapter_scale, use_cfg)
 
         # ControlNets
-        controlnet_kwargs_posi, controlnet_kwargs_nega, local_controlnet_kwargs = self.prepare_controlnet(controlnet_image, masks, controlnet_inpaint_mask, tiler_kwargs, enable_controlnet_on_negative)
+        controlnet_kwargs_posi, controlnet_kwargs_nega, local_controlnet_kwargs = self.prepare_controlnet(controlnet_image, masks, controlnet_inpaint_mask, tiler_kwargs, enable_controlnet_on_negative, use_cfg)
 
         # TeaCache
         tea_cache_kwargs = {"tea_cache": TeaCache(num_inference_steps, rel_l1_thresh=tea_cache_l1_thresh) if tea_cache_l1_thresh is not None else None}
+        if tea_cache_l1_thresh is not None and self.compile_model:
+            print("TeaCache is not supported by the compiled DiT. The uncompiled DiT is used instead.")
+
+        # The outputs of the DiT compiled with CUDA Graphs are overwritten by the next call, so they are cloned.
+        clone_output = self.compile_model and self.compile_mode in ("reduce-overhead", "max-autotune")
 
-        # Denoise
+        # Cache the embeddings of the DiT
         self.load_models_to_device(['dit', 'controlnet'])
-        for progress_id, timestep in enumerate(progress_bar_cmd(self.scheduler.timesteps)):
-            timestep = timestep.unsqueeze(0).to(self.device)
-
-            # Positive side
-            inference_callback = lambda prompt_emb_posi, controlnet_kwargs: lets_dance_flux(
-                dit=self.dit, controlnet=self.controlnet,
-                hidden_states=latents, timestep=timestep,
-                **prompt_emb_posi, **tiler_kwargs, **extra_input, **controlnet_kwargs, **ipadapter_kwargs_list_posi, **eligen_kwargs_posi, **tea_cache_kwargs,
-            )
-            noise_pred_posi = self.control_noise_via_local_prompts(
-                prompt_emb_posi, prompt_emb_locals, masks, mask_scales, inference_callback,
-                special_kwargs=controlnet_kwargs_posi, special_local_kwargs_list=local_controlnet_kwargs
+        prompt_emb_posi, prompt_emb_nega, prompt_emb_locals, extra_input = self.prepare_embedding_cache(prompt_emb_posi, prompt_emb_nega, prompt_emb_locals, extra_input)
+
+        # Batched classifier-free guidance
+        batch_cfg = batch_cfg and use_cfg and not self.cpu_offload and self.can_batch_cfg(prompt_emb_locals, controlnet_kwargs_posi, controlnet_kwargs_nega, eligen_kwargs_posi, eligen_kwargs_nega, tea_cache_kwargs)
+        if batch_cfg:
+            cfg_kwargs = self._broadcast_kwargs(
+                {**prompt_emb_posi, **extra_input, **ipadapter_kwargs_list_posi, **eligen_kwargs_posi},
+                {**prompt_emb_nega, **extra_input, **ipadapter_kwargs_list_nega, **eligen_kwargs_nega},
             )
 
-            # Inpaint
-            if enable_eligen_inpaint:
-                noise_pred_posi = self.inpaint_fusion(latents, input_latents, noise_pred_posi, fg_mask, bg_mask, progress_id)
+        # Denoise (with the cuDNN attention backend if available)
+        with sdpa_backend_context():
+            for progress_id, timestep in enumerate(progress_bar_cmd(self.scheduler.timesteps)):
+                timestep = self.scheduler.timesteps_gpu[progress_id: progress_id + 1]
+
+                if batch_cfg:
+                    # Positive and negative sides in a single forward
+                    noise_pred_posi, noise_pred_nega = lets_dance_flux(
+                        dit=self.dit, controlnet=self.controlnet,
+                        hidden_states=latents.repeat(2, 1, 1, 1), timestep=timestep.repeat(2),
+                        **cfg_kwargs, **tiler_kwargs,
+                        clone_output=clone_output,
+                    ).chunk(2, dim=0)
+                else:
+                    # Positive side
+                    inference_callback = lambda prompt_emb_posi, controlnet_kwargs: lets_dance_flux(
+                        dit=self.dit, controlnet=self.controlnet,
+                        hidden_states=latents, timestep=timestep,
+                        **prompt_emb_posi, **tiler_kwargs, **extra_input, **controlnet_kwargs, **ipadapter_kwargs_list_posi, **eligen_kwargs_posi, **tea_cache_kwargs,
+                        clone_output=clone_output,
+                    )
+                    noise_pred_posi = self.control_noise_via_local_prompts(
+                        prompt_emb_posi, prompt_emb_locals, masks, mask_scales, inference_callback,
+                        special_kwargs=controlnet_kwargs_posi, special_local_kwargs_list=local_controlnet_kwargs
+                    )
+
+                    # Negative side
+                    if use_cfg:
+                        noise_pred_nega = lets_dance_flux(
+                            dit=self.dit, controlnet=self.controlnet,
+                            hidden_states=latents, timestep=timestep,
+                            **prompt_emb_nega, **tiler_kwargs, **extra_input, **controlnet_kwargs_nega, **ipadapter_kwargs_list_nega, **eligen_kwargs_nega,
+                            clone_output=clone_output,
+                        )
+
+                # Inpaint
+                if enable_eligen_inpaint:
+                    noise_pred_posi = self.inpaint_fusion(latents, input_latents, noise_pred_posi, fg_mask, bg_mask, progress_id)
             
-            # Classifier-free guidance
-            if cfg_scale != 1.0:
-                # Negative side
-                noise_pred_nega = lets_dance_flux(
-                    dit=self.dit, controlnet=self.controlnet,
-                    hidden_states=latents, timestep=timestep,
-                    **prompt_emb_nega, **tiler_kwargs, **extra_input, **controlnet_kwargs_nega, **ipadapter_kwargs_list_nega, **eligen_kwargs_nega,
-                )
-                noise_pred = noise_pred_nega + cfg_scale * (noise_pred_posi - noise_pred_nega)
-            else:
-                noise_pred = noise_pred_posi
-
-            # Iterate
-            latents = self.scheduler.step(noise_pred, self.scheduler.timesteps[progress_id], latents)
-
-            # UI
-            if progress_bar_st is not None:
-                progress_bar_st.progress(progress_id / len(self.scheduler.timesteps))
+                # Classifier-free guidance
+                if use_cfg:
+                    noise_pred = noise_pred_nega + cfg_scale * (noise_pred_posi - noise_pred_nega)
+                else:
+                    noise_pred = noise_pred_posi
+
+                # Iterate
+                latents = self.scheduler.step(noise_pred, self.scheduler.timesteps[progress_id], latents)
+
+                # UI
+                if progress_bar_st is not None:
+                    progress_bar_st.progress(progress_id / len(self.scheduler.timesteps))
         
         # Decode image
         self.load_models_to_device(['vae_decoder'])
@@ -469,6 +689,58 @@ class FluxImagePipeline(BasePipeline):
         return image
 
 
+@torch.jit.script
+def fuse_inpaint_noise(latents, inpaint_latents, pred_noise, fg_mask, bg_mask, sigma, background_weight: float):
+    # Pure elementwise form of the masked merge, so that it can be fused into a single kernel.
+    # inpaint noise
+    inpaint_noise = (latents - inpaint_latents) / sigma
+    # merge noise
+    inpaint_noise = inpaint_noise * (1 - fg_mask) + pred_noise * fg_mask
+    inpaint_noise = (inpaint_noise + pred_noise * bg_mask * background_weight) / (1 + bg_mask * background_weight)
+    return inpaint_noise
+
+
+def sdpa_backend_context():
+    # cuDNN attention is preferred. The other backends are kept as fallbacks (e.g., on older GPUs or PyTorch versions).
+    try:
+        from torch.nn.attention import sdpa_kernel, SDPBackend
+    except ImportError:
+        return contextlib.nullcontext()
+    backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+    if hasattr(SDPBackend, "CUDNN_ATTENTION"):
+        backends = [SDPBackend.CUDNN_ATTENTION] + backends
+    try:
+        return sdpa_kernel(backends, set_priority=True)
+    except TypeError:
+        # `set_priority` is not supported in this version of PyTorch.
+        return sdpa_kernel(backends)
+
+
+def flux_dit_quant_config(quantize="fp8"):
+    # Only the linear layers in the transformer blocks are quantized.
+    # Embedders, modulations (AdaLayerNorm), RoPE and the output layers stay in the original precision.
+    fp8 = {"num_bits": (4, 3), "axis": None}
+    nvfp4 = {"num_bits": (2, 1), "block_sizes": {-1: 16, "type": "dynamic", "scale_bits": (4, 3)}, "axis": None, "enable": True}
+    if quantize == "fp8":
+        block_format = fp8
+    elif quantize == "nvfp4":
+        block_format = nvfp4
+    else:
+        raise ValueError(f"Unsupported quantization format: {quantize}. Please use \"fp8\" or \"nvfp4\".")
+    quant_cfg = {
+        "default": {"enable": False},
+        "*blocks.*weight_quantizer": block_format,
+        "*blocks.*input_quantizer": block_format,
+        # QKV projections in FP8 (not to_qkv_mlp of the single blocks, which also contains the MLP up-projection)
+        "*a_to_qkv*weight_quantizer": fp8,
+        "*a_to_qkv*input_quantizer": fp8,
+        "*b_to_qkv*weight_quantizer": fp8,
+        "*b_to_qkv*input_quantizer": fp8,
+        "*norm*": {"enable": False},
+    }
+    return {"quant_cfg": quant_cfg, "algorithm": "max"}
+
+
 class TeaCache:
     def __init__(self, num_inference_steps, rel_l1_thresh):
         self.num_inference_steps = num_inference_steps
@@ -528,8 +800,13 @@ def lets_dance_flux(
     tile_stride=64,
     entity_prompt_emb=None,
     entity_masks=None,
-    ipadapter_kwargs_list={},
+    ipadapter_kwargs_list=None,
     tea_cache: TeaCache = None,
+    image_rotary_emb=None,
+    context_embedded_prompt_emb=None,
+    pooled_cond=None,
+    guidance_cond=None,
+    clone_output=False,
     **kwargs
 ):
     if tiled:
@@ -547,6 +824,8 @@ def lets_dance_flux(
                 image_ids=None,
                 controlnet_frames=tiled_controlnet_frames,
                 tiled=False,
+                pooled_cond=pooled_cond,
+                guidance_cond=guidance_cond,
                 **kwargs
             )
         return FastTileWorker().tiled_forward(
@@ -560,6 +839,7 @@ def lets_dance_flux(
 
 
     # ControlNet
+    controlnet_res_stack, controlnet_single_res_stack = None, None
     if controlnet is not None and controlnet_frames is not None:
         controlnet_extra_kwargs = {
             "hidden_states": hidden_states,
@@ -577,70 +857,19 @@ def lets_dance_flux(
             controlnet_frames, **controlnet_extra_kwargs
         )
 
-    if image_ids is None:
-        image_ids = dit.prepare_image_ids(hidden_states)
-    
-    conditioning = dit.time_embedder(timestep, hidden_states.dtype) + dit.pooled_text_embedder(pooled_prompt_emb)
-    if dit.guidance_embedder is not None:
-        guidance = guidance * 1000
-        conditioning = conditioning + dit.guidance_embedder(guidance, hidden_states.dtype)
-
-    height, width = hidden_states.shape[-2:]
-    hidden_states = dit.patchify(hidden_states)
-    hidden_states = dit.x_embedder(hidden_states)
-
-    if entity_prompt_emb is not None and entity_masks is not None:
-        prompt_emb, image_rotary_emb, attention_mask = dit.process_entity_masks(hidden_states, prompt_emb, entity_prompt_emb, entity_masks, text_ids, image_ids)
-    else:
-        prompt_emb = dit.context_embedder(prompt_emb)
-        image_rotary_emb = dit.pos_embedder(torch.cat((text_ids, image_ids), dim=1))
-        attention_mask = None
-
-    # TeaCache
-    if tea_cache is not None:
-        tea_cache_update = tea_cache.check(dit, hidden_states, conditioning)
-    else:
-        tea_cache_update = False
-
-    if tea_cache_update:
-        hidden_states = tea_cache.update(hidden_states)
-    else:
-        # Joint Blocks
-        for block_id, block in enumerate(dit.blocks):
-            hidden_states, prompt_emb = block(
-                hidden_states,
-                prompt_emb,
-                conditioning,
-                image_rotary_emb,
-                attention_mask,
-                ipadapter_kwargs_list=ipadapter_kwargs_list.get(block_id, None)
-            )
-            # ControlNet
-            if controlnet is not None and controlnet_frames is not None:
-                hidden_states = hidden_states + controlnet_res_stack[block_id]
-
-        # Single Blocks
-        hidden_states = torch.cat([prompt_emb, hidden_states], dim=1)
-        num_joint_blocks = len(dit.blocks)
-        for block_id, block in enumerate(dit.single_blocks):
-            hidden_states, prompt_emb = block(
-                hidden_states,
-                prompt_emb,
-                conditioning,
-                image_rotary_emb,
-                attention_mask,
-                ipadapter_kwargs_list=ipadapter_kwargs_list.get(block_id + num_joint_blocks, None)
-            )
-            # ControlNet
-            if controlnet is not None and controlnet_frames is not None:
-                hidden_states[:, prompt_emb.shape[1]:] = hidden_states[:, prompt_emb.shape[1]:] + controlnet_single_res_stack[block_id]
-        hidden_states = hidden_states[:, prompt_emb.shape[1]:]
-
-        if tea_cache is not None:
-            tea_cache.store(hidden_states)
-
-    hidden_states = dit.final_norm_out(hidden_states, conditioning)
-    hidden_states = dit.final_proj_out(hidden_states)
-    hidden_states = dit.unpatchify(hidden_states, height, width)
+    # DiT forward (a single entry point, so that torch.compile can capture the whole model)
+    # TeaCache decides in Python whether to skip the blocks, so it bypasses the compiled call of the DiT.
+    dit_forward = dit.forward if tea_cache is not None else dit
+    hidden_states = dit_forward(
+        hidden_states, timestep, prompt_emb, pooled_prompt_emb, guidance, text_ids, image_ids,
+        entity_prompt_emb=entity_prompt_emb, entity_masks=entity_masks,
+        ipadapter_kwargs_list=ipadapter_kwargs_list,
+        controlnet_res_stack=controlnet_res_stack, controlnet_single_res_stack=controlnet_single_res_stack,
+        image_rotary_emb=image_rotary_emb, context_embedded_prompt_emb=context_embedded_prompt_emb,
+        pooled_cond=pooled_cond, guidance_cond=guidance_cond, tea_cache=tea_cache,
+    )
+    if clone_output:
+        # CUDA Graph outputs are overwritten by the next replay.
+        hidden_states = hidden_states.clone()
 
     return hidden_states
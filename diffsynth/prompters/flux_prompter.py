@@ -69,6 +69,6 @@ class FluxPrompter(BasePrompter):
         prompt_emb = self.encode_prompt_using_t5(prompt, self.text_encoder_2, self.tokenizer_2, t5_sequence_length, device)
 
         # text_ids
-        text_ids = torch.zeros(prompt_emb.shape[0], prompt_emb.shape[1], 3).to(device=device, dtype=prompt_emb.dtype)
+        text_ids = torch.zeros(prompt_emb.shape[0], prompt_emb.shape[1], 3, device=device, dtype=prompt_emb.dtype)
 
         return prompt_emb, pooled_prompt_emb, text_ids
@@ -15,7 +15,7 @@ class FlowMatchScheduler():
         self.set_timesteps(num_inference_steps)
 
 
-    def set_timesteps(self, num_inference_steps=100, denoising_strength=1.0, training=False, shift=None):
+    def set_timesteps(self, num_inference_steps=100, denoising_strength=1.0, training=False, shift=None, device=None):
         if shift is not None:
             self.shift = shift
         sigma_start = self.sigma_min + (self.sigma_max - self.sigma_min) * denoising_strength
@@ -29,6 +29,12 @@ class FlowMatchScheduler():
         if self.reverse_sigmas:
             self.sigmas = 1 - self.sigmas
         self.timesteps = self.sigmas * self.num_train_timesteps
+        # Keep sigmas and a copy of timesteps on the computation device to avoid host-device transfers in the denoising loop.
+        if device is not None:
+            self.sigmas = self.sigmas.to(device)
+            self.timesteps_gpu = self.timesteps.to(device)
+        else:
+            self.timesteps_gpu = self.timesteps
         if training:
             x = self.timesteps
             y = torch.exp(-2 * ((x - num_inference_steps / 2) / num_inference_steps) ** 2)